@@ -1,162 +1,404 @@
+from __future__ import annotations
+
 import os
-import json
-import base64
-import uuid
+import atexit
+import hashlib
+import secrets
 import logging
+import logging.handlers
+import queue
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from io import BytesIO
+from typing import Any
+import orjson
+import pybase64
+from cachetools import TTLCache
+from PIL import Image
+from google.api_core.exceptions import DeadlineExceeded, PreconditionFailed, RetryError, ServiceUnavailable
+from google.api_core.retry import Retry, if_exception_type
 from google.cloud import storage, vision, pubsub_v1
+from google.cloud.storage.retry import DEFAULT_RETRY
 from flask import Request, request, Flask
+from werkzeug.exceptions import HTTPException
 app = Flask(__name__)
 
-storage_client = storage.Client()
-vision_client = vision.ImageAnnotatorClient()
-publisher_client = pubsub_v1.PublisherClient()
+# Built on first use; the lock keeps concurrent first requests from each building their own
+_storage_client = None
+_vision_client = None
+_publisher_client = None
+_clients_lock = threading.Lock()
+
+def storage_client() -> storage.Client:
+    global _storage_client
+    if _storage_client is None:
+        with _clients_lock:
+            if _storage_client is None:
+                _storage_client = storage.Client()
+    return _storage_client
+
+def vision_client() -> vision.ImageAnnotatorClient:
+    global _vision_client
+    if _vision_client is None:
+        with _clients_lock:
+            if _vision_client is None:
+                _vision_client = vision.ImageAnnotatorClient()
+    return _vision_client
+
+def publisher_client() -> pubsub_v1.PublisherClient:
+    global _publisher_client
+    if _publisher_client is None:
+        with _clients_lock:
+            if _publisher_client is None:
+                _publisher_client = pubsub_v1.PublisherClient(
+                    batch_settings=pubsub_v1.types.BatchSettings(max_bytes=1024 * 1024, max_latency=0.01, max_messages=100)
+                )
+    return _publisher_client
 
 PROJECT_ID = os.environ.get('GCP_PROJECT', 'planar-cycle-467108-b4')
 BUCKET_NAME = f"{PROJECT_ID}.appspot.com"
+GCS_URI_PREFIX = f"gs://{BUCKET_NAME}/"
 EXTRACTION_TOPIC = f"projects/{PROJECT_ID}/topics/receipts-for-extraction"
 MAX_FILE_SIZE_MB = int(os.environ.get("MAX_FILE_SIZE_MB", "5"))
-ALLOWED_CONTENT_TYPES = ['image/jpeg', 'image/png', 'image/jpg', 'image/webp', 'application/pdf']
-
-logging.basicConfig(level=logging.INFO)
+# Base64 inflates the file by 4/3; leave some room for the rest of the JSON body
+app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE_MB * 1024 * 1024 * 4 // 3 + 64 * 1024
+ALLOWED_CONTENT_TYPES = frozenset({'image/jpeg', 'image/png', 'image/jpg', 'image/webp', 'application/pdf'})
+VISION_MAX_EDGE_PX = 1600
+VISION_SHRINK_MIN_BYTES = 512 * 1024
+# Decoding is ~4 bytes per pixel; images still larger after JPEG draft scaling go to Vision as-is
+VISION_MAX_DECODE_PIXELS = 40_000_000
+VISION_TIMEOUT_SECONDS = float(os.environ.get("VISION_TIMEOUT_SECONDS", "3"))
+# Transient UNAVAILABLE is retried, but only within the same deadline as the call itself
+_VISION_RETRY = Retry(predicate=if_exception_type(ServiceUnavailable), timeout=VISION_TIMEOUT_SECONDS)
+# Vision could not give a verdict in time; these must never fail open
+_VISION_UNAVAILABLE_ERRORS = (DeadlineExceeded, ServiceUnavailable, RetryError)
+_UNSAFE_LIKELIHOODS = frozenset({vision.Likelihood.LIKELY, vision.Likelihood.VERY_LIKELY})
+_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'%PDF-', 'application/pdf'),
+)
+_EXTENSIONS = {
+    'image/jpeg': 'jpg',
+    'image/jpg': 'jpg',
+    'image/png': 'png',
+    'image/webp': 'webp',
+    'application/pdf': 'pdf',
+}
+
+_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+# The create-only upload is already retried by the library's conditional default; this only
+# shortens its window from 120s to 30s so a stuck upload does not hold the request
+_UPLOAD_RETRY = DEFAULT_RETRY.with_deadline(30.0)
+# Mobile clients retry the same receipt; keep recent Vision verdicts keyed by content digest
+_VISION_CACHE = TTLCache(maxsize=1024, ttl=300)
+_VISION_CACHE_LOCK = threading.Lock()
+# Publishes the handler already answered 200 for; drained at shutdown within Cloud Run's 10s grace
+_pending_publishes: set[Future] = set()
+_pending_publishes_lock = threading.Lock()
+PUBLISH_DRAIN_TIMEOUT_SECONDS = 8.0
+
+# Handlers only enqueue records; the listener thread does the stream writes
+_log_queue = queue.SimpleQueue()
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+    handlers=[logging.handlers.QueueHandler(_log_queue)],
+)
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
-def ingestion_agent(request: Request):
+def _stop_publisher() -> None:
+    if _publisher_client is None:
+        return
+    # stop() only starts committing the open batches; wait on the futures for them to land
+    _publisher_client.stop()
+    with _pending_publishes_lock:
+        pending = set(_pending_publishes)
+    _, not_done = wait(pending, timeout=PUBLISH_DRAIN_TIMEOUT_SECONDS)
+    if not_done:
+        logger.error("%d messages to %s not published before shutdown", len(not_done), EXTRACTION_TOPIC)
+
+# Registered after the log listener so it runs first and can still log
+atexit.register(_stop_publisher)
+
+def ingestion_agent(request: Request) -> tuple[str, int]:
     try:
         logger.info("Received ingestion request")
-        request_json = request.get_json(silent=True)
-
-        if not request_json:
-            logger.error("Request JSON missing")
-            return 'Error: Missing request body.', 400
-        if not all(k in request_json for k in ['file_data_base64', 'user_id']):
-            logger.error("Request missing required keys")
-            return 'Error: Missing user_id or file_data_base64.', 400
-
-        user_id = request_json['user_id']
-        logger.info(f"Processing request for user: {user_id}")
-
-        image_content = base64.b64decode(request_json['file_data_base64'])
-
-        if not _verify_user_exists(user_id):
-            logger.warning(f"Unauthorized user: {user_id}")
-            return f"Error: Invalid or disabled user ID {user_id}", 403
 
-        if not _validate_file_size(image_content):
-            logger.warning("File size exceeds limit")
-            return f"Error: File exceeds size limit of {MAX_FILE_SIZE_MB}MB", 413
+        if request.mimetype == 'multipart/form-data':
+            # Raw file upload: no base64 string to hold in memory or decode
+            upload_file = request.files.get('file')
+            user_id = request.form.get('user_id')
+
+            if upload_file is None or not user_id:
+                logger.error("Request missing required form fields")
+                return 'Error: Missing user_id or file.', 400
+
+            logger.info("Processing request for user: %s", user_id)
+            image_content = upload_file.read()
+
+            if not _validate_file_size(len(image_content)):
+                logger.warning("File size exceeds limit")
+                return f"Error: File exceeds size limit of {MAX_FILE_SIZE_MB}MB", 413
+        else:
+            request_json = _load_request_json(request)
+
+            if not request_json:
+                logger.error("Request JSON missing")
+                return 'Error: Missing request body.', 400
+            if not all(k in request_json for k in ['file_data_base64', 'user_id']):
+                logger.error("Request missing required keys")
+                return 'Error: Missing user_id or file_data_base64.', 400
+            if not isinstance(request_json['file_data_base64'], str):
+                logger.error("file_data_base64 is not a string")
+                return 'Error: file_data_base64 is not valid base64.', 400
+
+            user_id = request_json['user_id']
+            logger.info("Processing request for user: %s", user_id)
+
+            if not _validate_file_size(_base64_decoded_size(request_json['file_data_base64'])):
+                logger.warning("File size exceeds limit")
+                return f"Error: File exceeds size limit of {MAX_FILE_SIZE_MB}MB", 413
+
+            # Lenient like the stdlib default: line-wrapped base64 (Android, MIME) must still decode.
+            # The size gate above already bounds what gets allocated here.
+            try:
+                image_content = pybase64.b64decode(request_json['file_data_base64'], validate=False)
+            except ValueError as e:  # binascii.Error (bad padding), or non-ASCII characters in the string
+                logger.warning("Invalid base64 payload: %s", e)
+                return 'Error: file_data_base64 is not valid base64.', 400
+            request_json['file_data_base64'] = None
 
         content_type = _detect_content_type(image_content)
-        logger.info(f"Detected content type: {content_type}")
+        logger.info("Detected content type: %s", content_type)
 
         if content_type not in ALLOWED_CONTENT_TYPES:
-            logger.warning(f"Rejected content type: {content_type}")
+            logger.warning("Rejected content type: %s", content_type)
             return f"Error: Content type {content_type} not allowed", 415
 
-        if not _perform_safety_check(image_content, content_type):
-            logger.warning("File failed safety check")
-            return "Error: Unsafe content detected in image", 422
-
-        if not _validate_content_structure(image_content, content_type):
-            logger.warning("File failed text structure check")
-            return "Error: Insufficient textual content detected", 422
-
-        destination_blob_name = f"processing-receipts/{user_id}-{uuid.uuid4()}.jpg"
-        blob = storage_client.bucket(BUCKET_NAME).blob(destination_blob_name)
-        blob.upload_from_string(image_content, content_type=content_type)
-        gcs_uri = f"gs://{BUCKET_NAME}/{destination_blob_name}"
-        logger.info(f"File uploaded successfully to: {gcs_uri}")
+        if not _verify_user_exists(user_id):
+            logger.warning("Unauthorized user: %s", user_id)
+            return f"Error: Invalid or disabled user ID {user_id}", 403
 
-        message_payload = json.dumps({'file_path': gcs_uri, 'user_id': user_id}).encode('utf-8')
-        future = publisher_client.publish(EXTRACTION_TOPIC, message_payload)
-        future.result()
-        logger.info(f"Published message to {EXTRACTION_TOPIC} for user {user_id}")
+        # Vision's images:annotate endpoint rejects PDFs, so only images are inspected
+        inspect_image = content_type.startswith('image/')
+        verdict = None
+        if inspect_image:
+            digest = hashlib.blake2b(image_content, digest_size=16).digest()
+            verdict = _cached_vision_verdict(digest)
+            # A retried receipt Vision already rejected is not uploaded just to be deleted again
+            if verdict is not None and not all(verdict):
+                return _vision_rejection(verdict)
+        else:
+            logger.info("Skipping Vision checks for %s", content_type)
+
+        destination_blob_name = f"processing-receipts/{user_id}-{secrets.token_hex(16)}.{_EXTENSIONS[content_type]}"
+        blob = storage_client().bucket(BUCKET_NAME).blob(destination_blob_name)
+        blob.metadata = {'user_id': user_id}
+        # Upload speculatively while Vision runs; rejected receipts are deleted again
+        upload = _EXECUTOR.submit(_upload_receipt, blob, image_content, content_type)
+
+        if inspect_image and verdict is None:
+            try:
+                verdict = _vision_inspect(image_content, digest)
+            except _VISION_UNAVAILABLE_ERRORS as e:
+                logger.warning("Vision checks unavailable within %.1fs: %s", VISION_TIMEOUT_SECONDS, e)
+                _discard_upload(blob, upload)
+                return "Error: Content checks unavailable, please retry", 503
+
+            if not all(verdict):
+                _discard_upload(blob, upload)
+                return _vision_rejection(verdict)
+
+        upload.result()
+        # Nothing below needs the payload; let it be freed before publishing
+        image_content = None
+        gcs_uri = GCS_URI_PREFIX + destination_blob_name
+        logger.info("File uploaded successfully to: %s", gcs_uri)
+
+        message_payload = orjson.dumps({'file_path': gcs_uri, 'user_id': user_id})
+        future = publisher_client().publish(EXTRACTION_TOPIC, message_payload)
+        with _pending_publishes_lock:
+            _pending_publishes.add(future)
+        future.add_done_callback(_log_publish_result)
+        logger.info("Queued message to %s for user %s", EXTRACTION_TOPIC, user_id)
 
         logger.info("Ingestion pipeline completed successfully")
         return "Receipt accepted and processing started.", 200
 
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.exception(f"Unhandled error during ingestion: {e}")
+        logger.exception("Unhandled error during ingestion: %s", e)
         return "Internal Server Error", 500
 
+def _load_request_json(request: Request) -> dict[str, Any] | None:
+    try:
+        body = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        return None
+    return body if isinstance(body, dict) else None
+
 def _verify_user_exists(user_id: str) -> bool:
     if user_id == 'sureshhackathon':
-        logger.info(f"User verified: {user_id}")
+        logger.info("User verified: %s", user_id)
         return True
     else:
-        logger.error(f"User verification failed: {user_id}")
+        logger.error("User verification failed: %s", user_id)
         return False
 
-def _validate_file_size(image_bytes: bytes) -> bool:
-    size_mb = len(image_bytes) / (1024 * 1024)
-    logger.info(f"File size: {size_mb:.2f} MB")
+def _base64_decoded_size(file_base64: str) -> int:
+    # Decoded size follows from the base64 length, so nothing is allocated to check it
+    padding = file_base64.count('=', -2)
+    return len(file_base64) * 3 // 4 - padding
+
+def _validate_file_size(size_bytes: int) -> bool:
+    size_mb = size_bytes / (1024 * 1024)
+    logger.info("File size: %.2f MB", size_mb)
     return size_mb <= MAX_FILE_SIZE_MB
 
 def _detect_content_type(image_bytes: bytes) -> str:
-    import imghdr
-    fmt = imghdr.what(None, h=image_bytes)
-    if fmt == 'jpeg':
-        return 'image/jpeg'
-    if fmt == 'png':
-        return 'image/png'
-    if fmt == 'webp':
+    for signature, content_type in _SIGNATURES:
+        if image_bytes.startswith(signature):
+            return content_type
+    if image_bytes.startswith(b'RIFF') and image_bytes.startswith(b'WEBP', 8):
         return 'image/webp'
     return 'application/octet-stream'
 
-def _perform_safety_check(image_bytes: bytes, content_type: str) -> bool:
-    try:
-        if not content_type.startswith('image/'):
-            logger.info("Skipping safety check for non-image content")
-            return True
+def _cached_vision_verdict(digest: bytes) -> tuple[bool, bool] | None:
+    with _VISION_CACHE_LOCK:
+        verdict = _VISION_CACHE.get(digest)
+    if verdict is not None:
+        logger.info("Reusing cached Vision verdict")
+    return verdict
 
-        image = vision.Image(content=image_bytes)
-        response = vision_client.safe_search_detection(image=image)
+def _vision_inspect(image_bytes: bytes, digest: bytes) -> tuple[bool, bool]:
+    try:
+        vision_request = vision.AnnotateImageRequest(
+            image=vision.Image(content=_shrink_for_vision(image_bytes)),
+            features=[
+                vision.Feature(type_=vision.Feature.Type.SAFE_SEARCH_DETECTION),
+                vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION),
+            ],
+        )
+        # Bounded by the deadline: a slow or unavailable Vision surfaces as a 503 instead of a hang
+        response = vision_client().batch_annotate_images(
+            requests=[vision_request], retry=_VISION_RETRY, timeout=VISION_TIMEOUT_SECONDS
+        ).responses[0]
 
         if response.error.message:
-            logger.error(f"Vision API error: {response.error.message}")
-            return False
+            logger.error("Vision API error: %s", response.error.message)
+            return False, True
+
+        verdict = _passes_safety_check(response), _has_enough_text(response)
+        with _VISION_CACHE_LOCK:
+            _VISION_CACHE[digest] = verdict
+        return verdict
 
-        unsafe = [vision.Likelihood.LIKELY, vision.Likelihood.VERY_LIKELY]
-        safe_search = response.safe_search_annotation
+    except _VISION_UNAVAILABLE_ERRORS:
+        raise
+    except Exception as e:
+        logger.error("Vision inspection failed: %s", e)
+        return True, True  # Fail open to avoid blocking
 
-        if (safe_search.adult in unsafe or
-            safe_search.violence in unsafe or
-            safe_search.racy in unsafe):
-            logger.warning(f"Unsafe content detected: {safe_search}")
-            return False
+def _shrink_for_vision(image_bytes: bytes) -> bytes:
+    if len(image_bytes) <= VISION_SHRINK_MIN_BYTES:
+        return image_bytes
 
-        logger.info("Content passed safety check")
-        return True
+    try:
+        image = Image.open(BytesIO(image_bytes))
+        if max(image.size) <= VISION_MAX_EDGE_PX:
+            return image_bytes
+        # JPEGs can be decoded at 1/2-1/8 scale; PNG/WebP ignore this and keep their full size
+        image.draft("RGB", (2 * VISION_MAX_EDGE_PX, 2 * VISION_MAX_EDGE_PX))
+        if image.width * image.height > VISION_MAX_DECODE_PIXELS:
+            logger.warning("Image too large to shrink (%dx%d), sending original", image.width, image.height)
+            return image_bytes
+
+        image.thumbnail((VISION_MAX_EDGE_PX, VISION_MAX_EDGE_PX), Image.Resampling.LANCZOS)
+        if image.has_transparency_data:
+            # Flattening alpha to black would hide dark text from OCR; use a white page instead
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        out = BytesIO()
+        image.convert("RGB").save(out, "JPEG", quality=85, optimize=True)
+        logger.info("Shrunk image for Vision from %d to %d bytes", len(image_bytes), out.tell())
+        return out.getvalue()
 
     except Exception as e:
-        logger.error(f"Safety check failed: {e}")
-        return True  # Fail open to avoid blocking
+        logger.warning("Could not shrink image for Vision, sending original: %s", e)
+        return image_bytes
 
-def _validate_content_structure(image_bytes: bytes, content_type: str) -> bool:
-    try:
-        if not content_type.startswith('image/'):
-            logger.info("Skipping text validation for non-image content")
-            return True
+def _passes_safety_check(response: vision.AnnotateImageResponse) -> bool:
+    safe_search = response.safe_search_annotation
 
-        image = vision.Image(content=image_bytes)
-        response = vision_client.text_detection(image=image)
+    if (safe_search.adult in _UNSAFE_LIKELIHOODS or
+        safe_search.violence in _UNSAFE_LIKELIHOODS or
+        safe_search.racy in _UNSAFE_LIKELIHOODS):
+        logger.warning("Unsafe content detected: %s", safe_search)
+        return False
 
-        if response.error.message:
-            logger.warning(f"Text detection error: {response.error.message}")
-            return True
+    logger.info("Content passed safety check")
+    return True
 
-        annotations = response.text_annotations
-        if not annotations or len(annotations[0].description.strip()) < 10:
-            logger.warning("Insufficient textual content detected")
-            return False
+def _has_enough_text(response: vision.AnnotateImageResponse) -> bool:
+    annotations = response.text_annotations
+    if not annotations or len(annotations[0].description.strip()) < 10:
+        logger.warning("Insufficient textual content detected")
+        return False
 
-        logger.info("Content passed text validation")
-        return True
+    logger.info("Content passed text validation")
+    return True
 
+def _upload_receipt(blob: storage.Blob, image_bytes: bytes, content_type: str) -> None:
+    try:
+        blob.upload_from_string(
+            image_bytes, content_type=content_type, checksum=None, if_generation_match=0, retry=_UPLOAD_RETRY,
+        )
+    except PreconditionFailed:
+        # Create-only upload with a random name: a 412 means an earlier attempt already created it
+        logger.info("Upload retry found %s already created", blob.name)
+
+def _vision_rejection(verdict: tuple[bool, bool]) -> tuple[str, int]:
+    safe_ok, _ = verdict
+    if not safe_ok:
+        logger.warning("File failed safety check")
+        return "Error: Unsafe content detected in image", 422
+
+    logger.warning("File failed text structure check")
+    return "Error: Insufficient textual content detected", 422
+
+def _discard_upload(blob: storage.Blob, upload: Future) -> None:
+    # The callback runs inline when the upload has already finished, so hand the
+    # DELETE to the executor rather than doing it on the request thread
+    upload.add_done_callback(lambda done: _EXECUTOR.submit(_delete_rejected_upload, blob, done))
+
+def _delete_rejected_upload(blob: storage.Blob, upload: Future) -> None:
+    if upload.exception() is not None:
+        return
+    try:
+        blob.delete()
+        logger.info("Deleted rejected upload: %s", blob.name)
     except Exception as e:
-        logger.error(f"Content structure validation failed: {e}")
-        return True
+        logger.error("Failed to delete rejected upload %s: %s", blob.name, e)
+
+def _log_publish_result(future: Future) -> None:
+    with _pending_publishes_lock:
+        _pending_publishes.discard(future)
+    error = future.exception()
+    if error:
+        logger.error("Publish to %s failed: %s", EXTRACTION_TOPIC, error)
+
+@app.errorhandler(413)
+def handle_request_too_large(e: HTTPException) -> tuple[str, int]:
+    logger.warning("Request body exceeds limit")
+    return f"Error: File exceeds size limit of {MAX_FILE_SIZE_MB}MB", 413
 
 @app.route("/", methods=["POST"])
-def handle_request():
+def handle_request() -> tuple[str, int]:
     return ingestion_agent(request)